@@ -0,0 +1,277 @@
+'''Snap every metric of a system onto one common time grid.
+
+The systems mix sampling rates (7333 has raw and 5 minute data,
+2107 has 15 minute meter data next to its electrical data, and the
+parquet systems differ in cadence and are irregular), so pivoting the
+long-format data directly gives NaN-riddled frames.  Here each record
+batch is reduced to partial per-bin aggregates, which are combined at the
+end, so memory scales with the output grid rather than the history.
+
+Aggregation rules, by metric category (see sensor_qa.py):
+    mean: sample mean (irradiance, temperature, wind, other)
+    integrate: energy-conserving, time-weighted mean (power)
+    last: last reading in the bin (energy counters)
+Every bin also records the fraction of it covered by readings.
+
+Wide csv data (e.g. the prize data) can be fed in after a pd.melt
+into measured_on, metric_id, value columns.'''
+
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from pathlib import Path
+from sensor_qa import metric_categories
+
+# prepare for future pandas 3.0 usage
+pd.options.mode.copy_on_write = True
+
+GRID_CHOICES = ['1min', '5min', '15min', '1h', '1D']
+CATEGORY_RULES = {
+    'irradiance': 'mean',
+    'power': 'integrate',
+    'energy': 'last',
+    'temperature': 'mean',
+    'wind': 'mean',
+    'other': 'mean',
+}
+# A reading is held until the next one, but for no longer than
+# HOLD_FACTOR times the usual interval of that metric,
+# so that outages do not count as covered.
+HOLD_FACTOR = 2
+# Combine the partial aggregates after this many batches.
+COMBINE_EVERY = 50
+
+_SUM_COLUMNS = ['sum_v', 'count', 'integral', 'covered']
+
+
+def _combine(partials):
+    '''Combine partial per-bin aggregates into one per (metric, bin).'''
+    df = pd.concat(partials, ignore_index=True)
+    grouped = df.groupby(['metric_id', 'bin'])
+    sums = grouped[_SUM_COLUMNS].sum()
+    lasts = df.loc[grouped['last_t'].idxmax(), ['metric_id', 'bin',
+                                                 'last_t', 'last_v']]
+    lasts = lasts.set_index(['metric_id', 'bin'])
+    return sums.join(lasts).reset_index()
+
+
+def _batch_partials(metric, t_ns, value, end_ns, bin_ns):
+    '''Per-bin partial aggregates for readings already sorted by
+    (metric, time), with each reading held from t_ns to end_ns.'''
+    # sample-based pieces, in the bin of each reading
+    sample_df = pd.DataFrame({
+        'metric_id': metric,
+        'bin': t_ns // bin_ns,
+        'sum_v': value,
+        'count': np.isfinite(value).astype('int64'),
+        'last_t': t_ns,
+        'last_v': value,
+    })
+    sample_df = sample_df.loc[np.isfinite(value)]
+    grouped = sample_df.groupby(['metric_id', 'bin'])
+    sample_part = grouped[['sum_v', 'count']].sum()
+    # readings are in time order within a metric, so the last row wins
+    sample_part = sample_part.join(grouped[['last_t', 'last_v']].last())
+    # time-held pieces, split over every bin each hold interval touches
+    held = np.isfinite(value) & (end_ns > t_ns)
+    h_metric = metric[held]
+    h_start = t_ns[held]
+    h_end = end_ns[held]
+    h_value = value[held]
+    first_bin = h_start // bin_ns
+    last_bin = (h_end - 1) // bin_ns
+    num_bins = last_bin - first_bin + 1
+    source = np.repeat(np.arange(h_start.shape[0]), num_bins)
+    step = np.arange(source.shape[0]) - np.repeat(
+        np.cumsum(num_bins) - num_bins, num_bins
+    )
+    bins = first_bin[source] + step
+    overlap = np.minimum(h_end[source], (bins + 1) * bin_ns)\
+        - np.maximum(h_start[source], bins * bin_ns)
+    hold_df = pd.DataFrame({
+        'metric_id': h_metric[source],
+        'bin': bins,
+        'integral': h_value[source] * overlap,
+        'covered': overlap.astype('float64'),
+    })
+    hold_part = hold_df.groupby(['metric_id', 'bin'])[
+        ['integral', 'covered']
+    ].sum()
+    part = sample_part.join(hold_part, how='outer').reset_index()
+    part[_SUM_COLUMNS] = part[_SUM_COLUMNS].fillna(0)
+    part['last_t'] = part['last_t'].fillna(np.iinfo(np.int64).min)\
+        .astype('int64')
+    return part
+
+
+def align_batches(batches, rules: dict, grid='15min',
+                  hold_factor=HOLD_FACTOR, drop_flagged=True):
+    '''Align a stream of long-format batches onto a common grid.
+
+    Parameters
+    ------------
+    batches: iterable of pd.DataFrame
+        Long-format data with measured_on, metric_id and value columns
+        (and optionally qa_flags).  Each metric should arrive in time
+        order across batches, as the per-day pvdata files do; a reading
+        older than the one before it is kept, but held for no time.
+    rules: dict
+        metric_id to 'mean', 'integrate' or 'last'.
+    grid: str
+        Bin width, any pd.Timedelta string; see GRID_CHOICES.
+        Bins start at local midnight (of measured_on).
+    hold_factor: float
+        Longest hold, in units of each metric's usual interval.
+    drop_flagged: bool
+        Ignore rows with nonzero qa_flags (see sensor_qa.py).
+
+    Returns
+    ------------
+    A long-format pd.DataFrame of metric_id, measured_on (bin start),
+    value, coverage and n_samples.  For 'integrate' metrics the value is
+    the mean power over the covered part of the bin, so the energy in the
+    bin is value * coverage * (bin width).
+    '''
+    bin_ns = pd.Timedelta(grid).value
+    # the last reading of each metric, still waiting for the next one
+    pending = pd.DataFrame({
+        'metric_id': pd.Series(dtype='int64'),
+        't_ns': pd.Series(dtype='int64'),
+        'value': pd.Series(dtype='float64'),
+    })
+    # usual interval of each metric, fixed from the first batch it is in
+    nominal = {}
+    partials = []
+    for batch_df in batches:
+        if drop_flagged and 'qa_flags' in batch_df.columns:
+            batch_df = batch_df.loc[batch_df['qa_flags'] == 0]
+        batch_df = pd.DataFrame({
+            'metric_id': batch_df['metric_id'].to_numpy(dtype='int64'),
+            't_ns': batch_df['measured_on'].to_numpy(
+                dtype='datetime64[ns]'
+            ).astype('int64'),
+            'value': batch_df['value'].to_numpy(dtype='float64'),
+        })
+        batch_df = pd.concat([pending, batch_df], ignore_index=True)
+        metric = batch_df['metric_id'].to_numpy()
+        t_ns = batch_df['t_ns'].to_numpy()
+        value = batch_df['value'].to_numpy()
+        # stable, so that readings out of time order stay visible
+        order = np.argsort(metric, kind='stable')
+        metric, t_ns, value = metric[order], t_ns[order], value[order]
+        is_last = np.ones(metric.shape[0], dtype=bool)
+        is_last[:-1] = metric[1:] != metric[:-1]
+        next_t = np.empty_like(t_ns)
+        next_t[:-1] = t_ns[1:]
+        dt = np.where(is_last, 0, next_t - t_ns)
+        new_metrics = set(np.unique(metric)) - set(nominal)
+        if len(new_metrics) > 0:
+            positive = (~is_last) & (dt > 0)
+            medians = pd.Series(dt[positive]).groupby(
+                metric[positive]
+            ).median()
+            for m in new_metrics:
+                # a metric with one reading so far: wait for more
+                if m in medians.index:
+                    nominal[m] = int(medians[m])
+        max_hold = hold_factor * pd.Series(metric).map(nominal)\
+            .fillna(0).to_numpy()
+        end_ns = t_ns + np.clip(dt, 0, max_hold).astype('int64')
+        pending = pd.DataFrame({
+            'metric_id': metric[is_last],
+            't_ns': t_ns[is_last],
+            'value': value[is_last],
+        })
+        done = ~is_last
+        partials.append(_batch_partials(
+            metric[done], t_ns[done], value[done], end_ns[done], bin_ns
+        ))
+        if len(partials) >= COMBINE_EVERY:
+            partials = [_combine(partials)]
+    # flush the last readings, each held for its usual interval
+    metric = pending['metric_id'].to_numpy()
+    t_ns = pending['t_ns'].to_numpy()
+    last_hold = pending['metric_id'].map(nominal).fillna(0).to_numpy()
+    partials.append(_batch_partials(
+        metric, t_ns, pending['value'].to_numpy(),
+        t_ns + last_hold.astype('int64'), bin_ns
+    ))
+    aligned = _combine(partials)
+    rule = aligned['metric_id'].map(rules).fillna('mean')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sample_mean = aligned['sum_v'] / aligned['count']
+        time_mean = aligned['integral'] / aligned['covered']
+    # upsampled bins with no reading of their own take the held value
+    has_sample = aligned['count'] > 0
+    aligned['value'] = np.select(
+        [rule == 'integrate', rule == 'last'],
+        [time_mean, aligned['last_v'].where(has_sample, time_mean)],
+        sample_mean.where(has_sample, time_mean)
+    )
+    aligned['coverage'] = (aligned['covered'] / bin_ns).clip(upper=1.)
+    aligned['n_samples'] = aligned['count'].astype('int64')
+    aligned['measured_on'] = (aligned['bin'] * bin_ns).astype(
+        'datetime64[ns]'
+    )
+    aligned = aligned.loc[
+        (aligned['n_samples'] > 0) | (aligned['coverage'] > 0)
+    ]
+    return aligned[
+        ['metric_id', 'measured_on', 'value', 'coverage', 'n_samples']
+    ].sort_values(['metric_id', 'measured_on'], ignore_index=True)
+
+
+def align_system(system_id: int, selected_metrics, metrics_df: pd.DataFrame,
+                 grid='15min', source_dir='../../data/raw/systems/parquet/',
+                 batch_size=1_000_000, **kwargs):
+    '''Align one system's parquet pvdata onto a common grid.
+
+    Parameters
+    ------------
+    system_id: int
+        The system to align.
+    selected_metrics: iterable
+        The metric_ids to align.
+    metrics_df: pd.DataFrame
+        The parquet-metrics table, to pick the rule for each metric.
+    grid: str
+        Bin width; see GRID_CHOICES.
+    source_dir: str
+        Directory holding one sub-directory of parquet per system.
+        Point it at '../../data/qa/systems/parquet/' to drop QA-flagged rows.
+    batch_size: int
+        Maximum rows per record batch.
+    kwargs:
+        Passed on to align_batches.
+    '''
+    selected_metrics = [int(m) for m in selected_metrics]
+    categories = metric_categories(
+        metrics_df.loc[metrics_df.loc[:, 'system_id'] == system_id]
+    )
+    rules = {
+        m: CATEGORY_RULES[categories.get(m, 'other')]
+        for m in selected_metrics
+    }
+    dataset = ds.dataset(Path(f'{source_dir}{system_id}/'),
+                         format='parquet')
+    columns = ['measured_on', 'metric_id', 'value']
+    if 'qa_flags' in dataset.schema.names:
+        columns.append('qa_flags')
+    batches = dataset.to_batches(
+        columns=columns,
+        filter=pc.field('metric_id').isin(selected_metrics),
+        batch_size=batch_size
+    )
+    return align_batches(
+        (batch.to_pandas() for batch in batches), rules, grid=grid, **kwargs
+    )
+
+
+def to_wide(aligned: pd.DataFrame, column='value'):
+    '''Pivot an aligned frame to one column per metric_id.'''
+    return aligned.pivot(
+        index='measured_on',
+        columns='metric_id',
+        values=column
+    )
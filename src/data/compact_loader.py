@@ -0,0 +1,342 @@
+'''Load a system's long-format parquet pvdata into a compact,
+Arrow-backed representation, so that many systems fit in RAM at once.
+
+Compared to read_and_filter (see parquet_filterer.ipynb), which gives
+int64 metric_id, float64 value, two nanosecond timestamps and
+(optionally) a repeated common_name string per row, the compact table has
+    metric_id: dictionary-encoded (categorical) metric ids
+    common_name: dictionary-encoded names, sharing the metric_id indices
+    measured_s: int32 seconds since a per-system epoch (local time)
+    utc_offset_min: int16 minutes from local time to UTC
+    value: float32
+    value_residual: only if some metrics lose more than value_atol as
+        float32 (e.g. cumulative energy counters), the part of value that
+        float32 drops, as the smallest float type that keeps it; zero for
+        the other metrics
+(plus qa_flags, if reading the output of sensor_qa.py).'''
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pathlib import Path
+
+# prepare for future pandas 3.0 usage
+pd.options.mode.copy_on_write = True
+
+EPOCH_METADATA_KEY = b'epoch'
+RESIDUAL_METADATA_KEY = b'residual_metrics'
+
+
+def _index_type(num_metrics: int):
+    '''Smallest signed integer type for the dictionary indices.'''
+    if num_metrics <= np.iinfo(np.int8).max:
+        return pa.int8()
+    if num_metrics <= np.iinfo(np.int16).max:
+        return pa.int16()
+    return pa.int32()
+
+
+def _residual_type(residuals: np.ndarray, value_atol: float):
+    '''Smallest float type holding the residuals to within value_atol.'''
+    for dtype in [np.float16, np.float32]:
+        with np.errstate(over='ignore'):
+            error = np.abs(residuals.astype(dtype).astype(np.float64)
+                           - residuals)
+        if np.all(error <= value_atol):
+            return dtype
+    # value - float32(value) is exact in float64
+    return np.float64
+
+
+def load_compact(system_id: int, selected_metrics, metrics_df=None,
+                 source_dir='../../data/raw/systems/parquet/',
+                 value_atol=1e-3, drop_duplicates=True,
+                 batch_size=1_000_000, report=True):
+    '''Read one system's data, batch by batch, into a compact pa.Table.
+
+    Parameters
+    ------------
+    system_id: int
+        The system ID number you wish to load.
+    selected_metrics: iterable
+        The metrics you want to choose.
+    metrics_df: pd.DataFrame or None
+        The parquet-metrics table.  If given, add a common_name column.
+    source_dir: str
+        Directory holding one sub-directory of parquet per system.
+        Point it at '../../data/qa/systems/parquet/' to keep the qa_flags.
+    value_atol: float
+        Largest absolute error allowed in value (+ value_residual).
+        Metrics that lose more as float32 get a value_residual.
+    drop_duplicates: bool
+        Drop *complete* duplicate rows, as read_and_filter does.
+    batch_size: int
+        Maximum rows per record batch while reading.
+    report: bool
+        Print the memory reduction (see memory_report) and the metrics
+        that needed a value_residual.
+
+    Returns
+    ------------
+    A pa.Table, sorted by time, with the epoch (an ISO timestamp) and the
+    metrics with a value_residual in the schema metadata.  Use
+    compact_to_pandas to get a DataFrame back.
+    '''
+    selected_metrics = [int(m) for m in selected_metrics]
+    metric_index = pd.Index(selected_metrics)
+    metric_dictionary = pa.array(selected_metrics, type=pa.int32())
+    index_type = _index_type(len(selected_metrics))
+    name_dictionary = None
+    if metrics_df is not None:
+        correspondence_dict = dict(zip(
+            metrics_df.loc[metrics_df.loc[:, 'system_id'] == system_id,
+                           'metric_id'],
+            metrics_df.loc[metrics_df.loc[:, 'system_id'] == system_id,
+                           'common_name']
+        ))
+        name_dictionary = pa.array(
+            [correspondence_dict.get(m) for m in selected_metrics],
+            type=pa.string()
+        )
+    source_path = Path(f'{source_dir}{system_id}/')
+    dataset = ds.dataset(source_path, format='parquet')
+    columns = ['measured_on', 'utc_measured_on', 'metric_id', 'value']
+    if 'qa_flags' in dataset.schema.names:
+        columns.append('qa_flags')
+    batches = dataset.to_batches(
+        columns=columns,
+        filter=pc.field('metric_id').isin(selected_metrics),
+        batch_size=batch_size
+    )
+    epoch = None
+    num_rows = 0
+    # rows that float32 rounds by more than value_atol, and by how much
+    inexact_rows = []
+    inexact_residuals = []
+    compact_batches = []
+    for batch in batches:
+        if batch.num_rows == 0:
+            continue
+        measured = batch.column('measured_on').to_numpy(
+            zero_copy_only=False
+        ).astype('datetime64[s]')
+        utc = batch.column('utc_measured_on').to_numpy(
+            zero_copy_only=False
+        ).astype('datetime64[s]')
+        if epoch is None:
+            epoch = measured.min().astype('datetime64[D]')\
+                .astype('datetime64[s]')
+        offsets = (measured - epoch).astype(np.int64)
+        if offsets.min() < np.iinfo(np.int32).min\
+                or offsets.max() > np.iinfo(np.int32).max:
+            raise ValueError(
+                f'System {system_id} spans more than 68 years '
+                + 'around its epoch; cannot use int32 offsets!'
+            )
+        utc_offset_min = ((utc - measured).astype(np.int64) // 60)\
+            .astype(np.int16)
+        indices = pa.array(
+            metric_index.get_indexer(
+                batch.column('metric_id').to_numpy(zero_copy_only=False)
+            ).astype(index_type.to_pandas_dtype())
+        )
+        arrays = {
+            'metric_id': pa.DictionaryArray.from_arrays(
+                indices, metric_dictionary
+            ),
+        }
+        if name_dictionary is not None:
+            arrays['common_name'] = pa.DictionaryArray.from_arrays(
+                indices, name_dictionary
+            )
+        arrays['measured_s'] = pa.array(offsets.astype(np.int32))
+        arrays['utc_offset_min'] = pa.array(utc_offset_min)
+        values = batch.column('value').to_numpy(zero_copy_only=False)\
+            .astype(np.float64)
+        values_32 = values.astype(np.float32)
+        with np.errstate(invalid='ignore'):
+            residuals = values - values_32.astype(np.float64)
+            # NaN in, NaN out, so NaN values are never inexact
+            inexact = np.abs(residuals) > value_atol
+        inexact_rows.append(num_rows + np.flatnonzero(inexact))
+        inexact_residuals.append(residuals[inexact])
+        arrays['value'] = pa.array(values_32)
+        if 'qa_flags' in columns:
+            arrays['qa_flags'] = batch.column('qa_flags')
+        compact_batches.append(pa.table(arrays))
+        num_rows += batch.num_rows
+    if len(compact_batches) == 0:
+        raise ValueError(
+            f'Mismatch between system_id {system_id} and metrics '
+            + f'{selected_metrics}.\n No values returned!'
+        )
+    compact = pa.concat_tables(compact_batches).combine_chunks()
+    # precision is decided per metric: only the metrics float32 is too
+    # coarse for (typically energy counters) carry a residual, and the
+    # residual is only kept where it exceeds value_atol
+    inexact_rows = np.concatenate(inexact_rows)
+    residual_metrics = []
+    if inexact_rows.shape[0] > 0:
+        inexact_residuals = np.concatenate(inexact_residuals)
+        residual_type = _residual_type(inexact_residuals, value_atol)
+        value_residual = np.zeros(num_rows, dtype=residual_type)
+        value_residual[inexact_rows] = inexact_residuals
+        compact = compact.add_column(
+            compact.schema.get_field_index('value') + 1,
+            'value_residual', pa.array(value_residual)
+        )
+        metric_indices = compact.column('metric_id').chunk(0).indices\
+            .to_numpy()
+        residual_metrics = sorted(
+            selected_metrics[i]
+            for i in np.unique(metric_indices[inexact_rows])
+        )
+    # sort by time, then metric (Arrow cannot sort dictionary columns,
+    # so sort on the indices), with the other columns as tie-breakers
+    # so that complete duplicates end up next to each other.
+    sort_keys = [
+        compact.column(name).to_numpy()
+        for name in ['qa_flags', 'value_residual', 'value',
+                     'utc_offset_min']
+        if name in compact.column_names
+    ]
+    sort_keys.append(
+        compact.column('metric_id').chunk(0).indices.to_numpy()
+    )
+    sort_keys.append(compact.column('measured_s').to_numpy())
+    order = np.lexsort(sort_keys)
+    if drop_duplicates:
+        # even with raw data, duplicates can happen!
+        # only drop *complete* duplicates for now.
+        repeat = np.ones(order.shape[0], dtype=bool)
+        for key in sort_keys:
+            sorted_key = key[order]
+            repeat[1:] &= (sorted_key[1:] == sorted_key[:-1])\
+                | (np.isnan(sorted_key[1:]) & np.isnan(sorted_key[:-1])
+                   if sorted_key.dtype.kind == 'f' else False)
+        repeat[0] = False
+        order = order[~repeat]
+    compact = compact.take(order)
+    compact = compact.replace_schema_metadata({
+        EPOCH_METADATA_KEY: str(epoch).encode(),
+        RESIDUAL_METADATA_KEY: ','.join(
+            str(m) for m in residual_metrics
+        ).encode(),
+    })
+    if report:
+        memory = memory_report(compact)
+        print(f'system_id={system_id}: {memory["num_rows"]} rows, '
+              + f'{memory["read_and_filter_bytes"] / 2**20:.1f} MiB as '
+              + 'read_and_filter -> '
+              + f'{memory["compact_bytes"] / 2**20:.1f} MiB compact '
+              + f'({memory["reduction"]:.1f}x smaller)')
+        if len(residual_metrics) > 0:
+            print(f'metrics {residual_metrics} are too precise for '
+                  + 'float32 and keep a value_residual.')
+    return compact
+
+
+def memory_report(compact: pa.Table):
+    '''Compare the compact table to the read_and_filter layout.
+
+    The read_and_filter layout has 8 bytes each for metric_id, value,
+    measured_on and utc_measured_on, plus (with name_change='add') an
+    object column of common_name strings per row.
+    '''
+    num_rows = compact.num_rows
+    wide_bytes = 32 * num_rows
+    if 'common_name' in compact.column_names:
+        names = compact.column('common_name').combine_chunks()
+        # 8 byte pointer per row, one python str per row
+        # (pandas does not intern the strings from to_pandas)
+        name_sizes = np.array(
+            [49 + len(s.encode()) if s is not None else 16
+             for s in names.dictionary.to_pylist()]
+        )
+        wide_bytes += 8 * num_rows + int(name_sizes[
+            names.indices.to_numpy(zero_copy_only=False)
+        ].sum())
+    compact_bytes = compact.get_total_buffer_size()
+    return {
+        'num_rows': num_rows,
+        'read_and_filter_bytes': wide_bytes,
+        'compact_bytes': compact_bytes,
+        'reduction': wide_bytes / max(compact_bytes, 1),
+    }
+
+
+def epoch_of(compact: pa.Table):
+    '''The per-system epoch, as a np.datetime64.'''
+    return np.datetime64(
+        compact.schema.metadata[EPOCH_METADATA_KEY].decode(), 's'
+    )
+
+
+def residual_metrics_of(compact: pa.Table):
+    '''The metric_ids whose values need value_residual on top of value.'''
+    names = compact.schema.metadata.get(RESIDUAL_METADATA_KEY, b'')
+    return [int(m) for m in names.decode().split(',') if m != '']
+
+
+def compact_to_pandas(compact: pa.Table, restore_timestamps=False,
+                      restore_values=False):
+    '''Convert the compact table to a DataFrame through Arrow.
+
+    The numeric columns are handed to pandas without copying
+    (split_blocks stops pandas consolidating them into one block),
+    and the dictionary columns become categoricals.
+
+    Parameters
+    ------------
+    compact: pa.Table
+        Output of load_compact.
+    restore_timestamps: bool
+        If True, also add measured_on and utc_measured_on
+        datetime64[s] columns.  These are new arrays (not zero-copy).
+    restore_values: bool
+        If True and there is a value_residual, replace value and
+        value_residual with their float64 sum (a new array).
+    '''
+    df = compact.to_pandas(split_blocks=True, zero_copy_only=False)
+    if restore_values and 'value_residual' in df.columns:
+        df['value'] = df['value'].to_numpy().astype(np.float64)\
+            + df['value_residual'].to_numpy()
+        df = df.drop(columns='value_residual')
+    if restore_timestamps:
+        epoch = epoch_of(compact)
+        measured = epoch + df['measured_s'].to_numpy().astype(
+            'timedelta64[s]'
+        )
+        df['measured_on'] = measured
+        df['utc_measured_on'] = measured + (
+            df['utc_offset_min'].to_numpy().astype('timedelta64[m]')
+        )
+    return df
+
+
+def save_compact(compact: pa.Table, system_id: int,
+                 save_dir='../../data/compact/systems/parquet/'):
+    '''Save the compact table, epoch included, as one parquet file.'''
+    save_path = Path(save_dir)
+    save_path.mkdir(parents=True, exist_ok=True)
+    pq.write_table(compact, save_path / f'{system_id}.parquet')
+
+
+def read_compact(system_id: int,
+                 save_dir='../../data/compact/systems/parquet/'):
+    '''Read back a table written by save_compact.'''
+    return pq.read_table(Path(save_dir) / f'{system_id}.parquet')
+
+
+if __name__ == '__main__':
+    metrics_dir = Path('../../data/raw/parquet-metrics/')
+    metrics_pq = pq.ParquetDataset(metrics_dir)
+    metrics_df = metrics_pq.read().to_pandas()
+    system_id = 34
+    my_metrics = [2694, 2695, 2679, 2686, 2687, 2688, 2689]
+    compact_34 = load_compact(system_id, my_metrics, metrics_df)
+    print(memory_report(compact_34))
+    print(compact_to_pandas(compact_34).info())
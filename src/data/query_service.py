@@ -0,0 +1,458 @@
+'''A long-running local query service over the per-system parquet data.
+
+Start it once, and every notebook or analysis script can ask it for
+time-range and metric_id slices of any system, instead of re-opening the
+system directory with pq.ParquetDataset and decoding the same row groups
+again.  Decoded column chunks are kept in a size-bounded LRU cache, and
+per-day statistics are computed once per system.
+
+In-process:
+    service = PVDataService()
+    table = service.get(34, [2694, 2695], '2019-01-01', '2019-02-01')
+Over a local socket (Arrow IPC):
+    python query_service.py serve      # in one terminal
+    table = query(34, [2694, 2695], '2019-01-01', '2019-02-01')
+Benchmark of the cache hit rates:
+    python query_service.py benchmark'''
+
+import json
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# prepare for future pandas 3.0 usage
+pd.options.mode.copy_on_write = True
+
+# choices -- choose here
+HOST = '127.0.0.1'
+PORT = 50_726
+CACHE_BYTES = 2 * 2**30
+DEFAULT_COLUMNS = ['measured_on', 'utc_measured_on', 'metric_id', 'value']
+
+
+def _to_datetime64(stamp):
+    '''None, a string, or a datetime-like to np.datetime64[ns] (or None).'''
+    if stamp is None:
+        return None
+    return pd.Timestamp(stamp).to_datetime64().astype('datetime64[ns]')
+
+
+class PVDataService:
+    '''Serve slices of the per-system parquet data from memory.
+
+    Parameters
+    ------------
+    source_dir: str
+        Directory holding one sub-directory of parquet per system.
+        Point it at '../../data/qa/systems/parquet/' to serve qa_flags too.
+    cache_bytes: int
+        Upper bound on the decoded column chunks kept in memory.
+    '''
+
+    def __init__(self, source_dir='../../data/raw/systems/parquet/',
+                 cache_bytes=CACHE_BYTES):
+        self.source_dir = source_dir
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._row_groups = {}
+        self._daily = {}
+        self._metadata = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # --- metadata -----------------------------------------------------
+    def _system_row_groups(self, system_id: int):
+        '''Row groups of a system, with their time and metric_id ranges.
+
+        The ranges come from the parquet statistics; a row group without
+        statistics gets an open range and is always read.
+        '''
+        with self._lock:
+            if system_id in self._row_groups:
+                return self._row_groups[system_id]
+        system_dir = Path(f'{self.source_dir}{system_id}/')
+        if not system_dir.is_dir():
+            raise ValueError(f'No data directory for system {system_id}!')
+        row_groups = []
+        for file_path in sorted(system_dir.rglob('*.parquet')):
+            # only the footer is kept; files are opened again to decode
+            metadata = pq.read_metadata(file_path)
+            names = metadata.schema.to_arrow_schema().names
+            for i in range(metadata.num_row_groups):
+                row_group = metadata.row_group(i)
+                entry = {
+                    'path': str(file_path),
+                    'row_group': i,
+                    'num_rows': row_group.num_rows,
+                    'columns': names,
+                    't_min': None, 't_max': None,
+                    'm_min': None, 'm_max': None,
+                }
+                for prefix, name in [('t', 'measured_on'),
+                                     ('m', 'metric_id')]:
+                    stats = row_group.column(names.index(name)).statistics
+                    if stats is not None and stats.has_min_max:
+                        entry[f'{prefix}_min'] = stats.min
+                        entry[f'{prefix}_max'] = stats.max
+                if entry['t_min'] is not None:
+                    entry['t_min'] = _to_datetime64(entry['t_min'])
+                    entry['t_max'] = _to_datetime64(entry['t_max'])
+                row_groups.append(entry)
+            with self._lock:
+                self._metadata[str(file_path)] = metadata
+        with self._lock:
+            self._row_groups[system_id] = row_groups
+        return row_groups
+
+    def _read_row_group(self, path: str, row_group: int, columns):
+        '''Read columns of one row group, opening the file only for it.
+
+        No file stays open between reads, as a system can have thousands
+        of daily files; the cached footer saves parsing it again.
+        '''
+        with self._lock:
+            metadata = self._metadata[path]
+        with pq.ParquetFile(path, metadata=metadata) as parquet_file:
+            return parquet_file.read_row_group(row_group, columns=columns)
+
+    # --- the LRU cache ------------------------------------------------
+    def _column(self, path: str, row_group: int, column: str):
+        '''A decoded column chunk, from the cache if possible.'''
+        key = (path, row_group, column)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+        # decode outside the lock, so other requests are not held up
+        array = self._read_row_group(
+            path, row_group, [column]
+        ).column(0).combine_chunks()
+        size = array.nbytes
+        with self._lock:
+            if key not in self._cache and size <= self.cache_bytes:
+                self._cache[key] = array
+                self._cached_bytes += size
+                while self._cached_bytes > self.cache_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cached_bytes -= evicted.nbytes
+                    self.evictions += 1
+        return array
+
+    def cache_info(self):
+        '''Hit/miss counts and memory use of the cache.'''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else np.nan,
+                'evictions': self.evictions,
+                'entries': len(self._cache),
+                'cached_bytes': self._cached_bytes,
+                'cache_bytes': self.cache_bytes,
+            }
+
+    def clear_cache(self):
+        '''Drop every cached column chunk and reset the counters.'''
+        with self._lock:
+            self._cache.clear()
+            self._cached_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    # --- queries ------------------------------------------------------
+    def get(self, system_id: int, metric_ids=None, start=None, end=None,
+            columns=None):
+        '''Rows of one system in [start, end) for the given metric_ids.
+
+        Parameters
+        ------------
+        system_id: int
+            The system to read.
+        metric_ids: iterable or None
+            The metrics you want to choose; None for all of them.
+        start, end: str, datetime-like, or None
+            Local-time (measured_on) bounds; None for open-ended.
+        columns: list or None
+            Columns to return; defaults to DEFAULT_COLUMNS,
+            plus qa_flags if the data has it.
+
+        Returns
+        ------------
+        A pa.Table.
+        '''
+        start = _to_datetime64(start)
+        end = _to_datetime64(end)
+        metric_set = None
+        if metric_ids is not None:
+            metric_set = sorted(int(m) for m in metric_ids)
+        pieces = []
+        for entry in self._system_row_groups(system_id):
+            if not self._may_match(entry, metric_set, start, end):
+                continue
+            if columns is None:
+                wanted = DEFAULT_COLUMNS + (
+                    ['qa_flags'] if 'qa_flags' in entry['columns'] else []
+                )
+            else:
+                wanted = list(columns)
+            # each column chunk is looked up once per row group
+            chunks = {}
+
+            def chunk(column):
+                if column not in chunks:
+                    chunks[column] = self._column(
+                        entry['path'], entry['row_group'], column
+                    )
+                return chunks[column]
+
+            mask = None
+            if metric_set is not None:
+                metrics = chunk('metric_id')
+                mask = pc.is_in(
+                    metrics,
+                    value_set=pa.array(metric_set).cast(metrics.type)
+                )
+            if start is not None or end is not None:
+                times = chunk('measured_on')
+                for bound, compare in [(start, pc.greater_equal),
+                                       (end, pc.less)]:
+                    if bound is None:
+                        continue
+                    in_range = compare(
+                        times,
+                        pa.scalar(pd.Timestamp(bound), type=times.type)
+                    )
+                    mask = in_range if mask is None\
+                        else pc.and_(mask, in_range)
+            arrays = [chunk(column) for column in wanted]
+            piece = pa.table(arrays, names=wanted)
+            if mask is not None:
+                piece = piece.filter(mask)
+            if piece.num_rows > 0:
+                pieces.append(piece)
+        if len(pieces) == 0:
+            return self._empty_result(system_id, columns)
+        return pa.concat_tables(pieces, promote_options='default')
+
+    def _empty_result(self, system_id: int, columns=None):
+        '''A zero-row table with the columns and types get would return.'''
+        row_groups = self._system_row_groups(system_id)
+        if len(row_groups) == 0:
+            # no files for this system, so no schema to go by
+            return pa.table({})
+        entry = row_groups[0]
+        with self._lock:
+            metadata = self._metadata[entry['path']]
+        schema = metadata.schema.to_arrow_schema()
+        if columns is None:
+            columns = DEFAULT_COLUMNS + (
+                ['qa_flags'] if 'qa_flags' in entry['columns'] else []
+            )
+        return pa.schema([schema.field(c) for c in columns]).empty_table()
+
+    @staticmethod
+    def _may_match(entry, metric_set, start, end):
+        '''Use the row-group statistics to skip row groups.'''
+        if metric_set is not None and entry['m_min'] is not None:
+            if metric_set[-1] < entry['m_min']\
+                    or metric_set[0] > entry['m_max']:
+                return False
+        if entry['t_min'] is not None:
+            if start is not None and entry['t_max'] < start:
+                return False
+            if end is not None and entry['t_min'] >= end:
+                return False
+        return True
+
+    def daily_stats(self, system_id: int, metric_ids=None, start=None,
+                    end=None):
+        '''Per (metric_id, day) count, mean, min and max of value.
+
+        Computed once per system, from every row group, and kept.
+        Days are local (measured_on) days.
+        '''
+        with self._lock:
+            daily = self._daily.get(system_id)
+        if daily is None:
+            parts = []
+            for entry in self._system_row_groups(system_id):
+                # read directly: this should not flush the cache
+                piece = self._read_row_group(
+                    entry['path'], entry['row_group'],
+                    ['measured_on', 'metric_id', 'value']
+                ).to_pandas()
+                piece['day'] = piece['measured_on'].dt.floor('D')
+                parts.append(piece.groupby(['metric_id', 'day'])['value']
+                             .agg(['count', 'sum', 'min', 'max']))
+            daily = pd.concat(parts).groupby(level=[0, 1]).agg({
+                'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max'
+            })
+            daily['mean'] = daily['sum'] / daily['count']
+            daily = daily.drop(columns='sum').reset_index()
+            with self._lock:
+                self._daily[system_id] = daily
+        selection = pd.Series(True, index=daily.index)
+        if metric_ids is not None:
+            selection &= daily['metric_id'].isin(list(metric_ids))
+        if start is not None:
+            selection &= daily['day'] >= pd.Timestamp(start).floor('D')
+        if end is not None:
+            selection &= daily['day'] < pd.Timestamp(end)
+        return pa.Table.from_pandas(daily.loc[selection],
+                                    preserve_index=False)
+
+
+# --- serving over a local socket --------------------------------------
+class _Handler(socketserver.StreamRequestHandler):
+    '''One JSON request line in; a JSON status line and
+    (if ok) an Arrow IPC stream out.'''
+
+    def handle(self):
+        service = self.server.service
+        try:
+            request = json.loads(self.rfile.readline())
+            operation = request.pop('op', 'get')
+            if operation == 'get':
+                table = service.get(**request)
+            elif operation == 'daily':
+                table = service.daily_stats(**request)
+            elif operation == 'cache_info':
+                table = pa.table({
+                    key: [value]
+                    for key, value in service.cache_info().items()
+                })
+            else:
+                raise ValueError(f'Not a valid op: {operation}')
+        except BaseException as e:
+            self.wfile.write((json.dumps({'ok': False, 'error': repr(e)})
+                              + '\n').encode())
+            return
+        self.wfile.write(b'{"ok": true}\n')
+        with pa.ipc.new_stream(self.wfile, table.schema) as writer:
+            writer.write_table(table)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve(service=None, host=HOST, port=PORT):
+    '''Serve a PVDataService on a local socket until interrupted.'''
+    if service is None:
+        service = PVDataService()
+    with _Server((host, port), _Handler) as server:
+        server.service = service
+        print(f'Serving {service.source_dir} on {host}:{port}')
+        server.serve_forever()
+
+
+def _request(payload: dict, host=HOST, port=PORT):
+    with socket.create_connection((host, port)) as sock:
+        with sock.makefile('rwb') as stream:
+            stream.write((json.dumps(payload) + '\n').encode())
+            stream.flush()
+            status = json.loads(stream.readline())
+            if not status['ok']:
+                raise RuntimeError(f'Query failed: {status["error"]}')
+            return pa.ipc.open_stream(stream).read_all()
+
+
+def query(system_id: int, metric_ids=None, start=None, end=None,
+          columns=None, host=HOST, port=PORT):
+    '''Client side of PVDataService.get, over the local socket.'''
+    return _request({
+        'op': 'get',
+        'system_id': int(system_id),
+        'metric_ids': None if metric_ids is None
+        else [int(m) for m in metric_ids],
+        'start': None if start is None else str(start),
+        'end': None if end is None else str(end),
+        'columns': columns,
+    }, host=host, port=port)
+
+
+def query_daily(system_id: int, metric_ids=None, start=None, end=None,
+                host=HOST, port=PORT):
+    '''Client side of PVDataService.daily_stats, over the local socket.'''
+    return _request({
+        'op': 'daily',
+        'system_id': int(system_id),
+        'metric_ids': None if metric_ids is None
+        else [int(m) for m in metric_ids],
+        'start': None if start is None else str(start),
+        'end': None if end is None else str(end),
+    }, host=host, port=port)
+
+
+# --- benchmark ----------------------------------------------------------
+def benchmark(service: PVDataService, system_id: int, metric_ids,
+              num_queries=200, window_days=30, seed=0):
+    '''Time random time-range queries against one system,
+    once from a cold cache and then repeated from a warm one,
+    and report the cache hit rates.'''
+    rng = np.random.default_rng(seed)
+    row_groups = service._system_row_groups(system_id)
+    t_mins = [e['t_min'] for e in row_groups if e['t_min'] is not None]
+    t_maxs = [e['t_max'] for e in row_groups if e['t_max'] is not None]
+    first = min(t_mins).astype('datetime64[D]')
+    last = max(t_maxs).astype('datetime64[D]')
+    span = max(int((last - first) / np.timedelta64(1, 'D'))
+               - window_days, 1)
+    starts = first + rng.integers(0, span, num_queries).astype(
+        'timedelta64[D]'
+    )
+    results = {}
+    service.clear_cache()
+    for label in ['cold', 'warm']:
+        hits_before = service.hits
+        misses_before = service.misses
+        st = time.time()
+        for query_start in starts:
+            service.get(system_id, metric_ids, query_start,
+                        query_start + np.timedelta64(window_days, 'D'))
+        et = time.time()
+        hits = service.hits - hits_before
+        lookups = hits + service.misses - misses_before
+        results[label] = {
+            'seconds': et - st,
+            'hit_rate': hits / lookups if lookups else np.nan,
+        }
+        print(f'{label}: {num_queries} queries in {et - st:.3f} s, '
+              + f'hit rate {results[label]["hit_rate"]:.3f}')
+    info = service.cache_info()
+    print(f'cache: {info["entries"]} chunks, '
+          + f'{info["cached_bytes"] / 2**20:.1f} MiB, '
+          + f'{info["evictions"]} evictions')
+    return results
+
+
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'serve'
+    if mode == 'serve':
+        serve()
+    elif mode == 'benchmark':
+        benchmark(
+            PVDataService(),
+            34,
+            [2694, 2695, 2679, 2686, 2687, 2688, 2689]
+        )
+    else:
+        raise ValueError('Not a valid mode; use "serve" or "benchmark".')
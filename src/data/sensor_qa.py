@@ -0,0 +1,491 @@
+'''Data-quality (QA) stage for the long-format parquet pvdata.
+
+Rather than dropping rows, every record batch of a system is passed
+through a set of vectorized rules (chosen per metric category), and
+the result is written back out with a compact uint8 bitmask column,
+`qa_flags`.  A per-system summary is appended to a QA table, so that
+bad systems can be rejected before any expensive RdTools work.'''
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pathlib import Path
+from pvlib import solarposition
+
+# prepare for future pandas 3.0 usage
+pd.options.mode.copy_on_write = True
+
+# One bit per rule.  A row with qa_flags == 0 passed everything.
+QA_OUT_OF_RANGE = 1
+QA_NEGATIVE_POWER = 2
+QA_STUCK = 4
+QA_RATE_OF_CHANGE = 8
+QA_NIGHT_NONZERO = 16
+QA_CLIPPED = 32
+QA_TIME_JUMP = 64
+QA_FLAG_NAMES = {
+    QA_OUT_OF_RANGE: 'out_of_range',
+    QA_NEGATIVE_POWER: 'negative_power',
+    QA_STUCK: 'stuck',
+    QA_RATE_OF_CHANGE: 'rate_of_change',
+    QA_NIGHT_NONZERO: 'night_nonzero',
+    QA_CLIPPED: 'clipped',
+    QA_TIME_JUMP: 'time_jump',
+}
+
+# Metric categories, in the order they are checked against the
+# sensor_name/common_name of the parquet-metrics table.
+# 'factor' comes first so that power factors do not count as power,
+# and 'energy' before 'pow' so that energy counters are not power either.
+METRIC_CATEGORY_FRAGMENTS = [
+    ('other', 'factor'),
+    ('energy', 'energ'),
+    ('irradiance', 'rrad'),
+    ('power', 'pow'),
+    ('temperature', 'temp'),
+    ('wind', 'wind'),
+]
+METRIC_CATEGORIES = [
+    'irradiance', 'power', 'energy', 'temperature', 'wind', 'other'
+]
+
+# Rules per category.  np.nan switches a rule off.
+#   min/max: plausible range of values
+#   max_rate: largest plausible change per minute
+#   stuck_run: number of identical nonzero readings in a row
+#       before we call the sensor stuck
+#   night_max: largest plausible value while the sun is down
+#   clip_tolerance/clip_min_minutes: consecutive readings that stay
+#       within clip_tolerance (as a fraction) of the daily maximum, and
+#       so barely change, for at least clip_min_minutes are an
+#       inverter-clipping plateau.  (The rounded peak of a smooth,
+#       unclipped day stays in that band for well under half an hour.)
+# Power is not given a range or night limit, because the units
+# (W vs. kW) and the capacity vary from system to system;
+# negative power is flagged separately.
+DEFAULT_QA_RULES = {
+    'irradiance': {
+        'min': -10., 'max': 1500., 'max_rate': 1000., 'stuck_run': 30,
+        'night_max': 10., 'clip_tolerance': np.nan, 'clip_min_minutes': 0,
+    },
+    'power': {
+        'min': np.nan, 'max': np.nan, 'max_rate': np.nan, 'stuck_run': 30,
+        'night_max': np.nan, 'clip_tolerance': 0.0005,
+        'clip_min_minutes': 30,
+    },
+    'energy': {
+        'min': 0., 'max': np.nan, 'max_rate': np.nan, 'stuck_run': 0,
+        'night_max': np.nan, 'clip_tolerance': np.nan, 'clip_min_minutes': 0,
+    },
+    'temperature': {
+        'min': -40., 'max': 100., 'max_rate': 5., 'stuck_run': 60,
+        'night_max': np.nan, 'clip_tolerance': np.nan, 'clip_min_minutes': 0,
+    },
+    'wind': {
+        'min': 0., 'max': 60., 'max_rate': np.nan, 'stuck_run': 120,
+        'night_max': np.nan, 'clip_tolerance': np.nan, 'clip_min_minutes': 0,
+    },
+    'other': {
+        'min': np.nan, 'max': np.nan, 'max_rate': np.nan, 'stuck_run': 0,
+        'night_max': np.nan, 'clip_tolerance': np.nan, 'clip_min_minutes': 0,
+    },
+}
+
+# The analytical zenith ignores refraction and the equation of time
+# is approximate, so only call it night a little below the horizon.
+NIGHT_ZENITH = 95.
+# Negative power above this is treated as inverter standby draw.
+NEGATIVE_POWER_TOLERANCE = -0.01
+# Forward gaps larger than this count as a timestamp jump.
+MAX_GAP = pd.Timedelta(hours=25)
+
+QA_SUMMARY_PATH = '../../data/core/system_qa_summary.csv'
+
+
+def metric_categories(metrics_df: pd.DataFrame):
+    '''Assign each metric_id in the parquet-metrics table to a category.
+
+    Parameters
+    ------------
+    metrics_df: pd.DataFrame
+        The parquet-metrics table (or the rows for one system).
+        Needs metric_id, sensor_name and common_name columns.
+
+    Returns
+    ------------
+    A dict of metric_id to one of METRIC_CATEGORIES.
+    '''
+    names = (
+        metrics_df['sensor_name'].fillna('') + ' '
+        + metrics_df['common_name'].fillna('')
+    ).str.lower()
+    categories = pd.Series('other', index=metrics_df.index)
+    assigned = pd.Series(False, index=metrics_df.index)
+    for category, fragment in METRIC_CATEGORY_FRAGMENTS:
+        hits = names.str.contains(fragment, regex=False) & ~assigned
+        categories[hits] = category
+        assigned = assigned | hits
+    return dict(zip(metrics_df['metric_id'].astype('int64'), categories))
+
+
+def _rule_table(rules):
+    '''Turn the rules dict into a DataFrame indexed by category code.'''
+    table = pd.DataFrame([rules[cat] for cat in METRIC_CATEGORIES])
+    return table.astype('float64')
+
+
+def _night_mask(utc_times: np.ndarray, latitude: float, longitude: float):
+    '''True where the sun is (comfortably) below the horizon.'''
+    times = pd.DatetimeIndex(utc_times).tz_localize('UTC')
+    dayofyear = times.dayofyear.to_numpy()
+    declination = solarposition.declination_spencer71(dayofyear)
+    eot = solarposition.equation_of_time_spencer71(dayofyear)
+    hourangle = solarposition.hour_angle(times, longitude, eot)
+    zenith = solarposition.solar_zenith_analytical(
+        np.radians(latitude), np.radians(hourangle), declination
+    )
+    return np.degrees(zenith) > NIGHT_ZENITH
+
+
+def qa_batch(batch_df: pd.DataFrame, category_codes: dict, rule_table,
+             latitude: float, longitude: float, carry: dict):
+    '''Compute the QA bitmask for one record batch.
+
+    Parameters
+    ------------
+    batch_df: pd.DataFrame
+        Long-format pvdata: measured_on, utc_measured_on, metric_id, value.
+    category_codes: dict
+        metric_id to position in METRIC_CATEGORIES.
+    rule_table: pd.DataFrame
+        Output of _rule_table.
+    latitude, longitude: float
+        Site location, for the night mask.
+    carry: dict
+        metric_id to (last value, run length, last timestamp)
+        from the previous batch.  Updated in place, so that stuck runs,
+        rates of change and timestamp jumps continue across batches.
+        (A stuck run that started in an earlier batch is only flagged
+        from this batch onwards.)
+
+    Returns
+    ------------
+    A np.uint8 array of flags, in the original row order of batch_df.
+    '''
+    num_rows = batch_df.shape[0]
+    flags = np.zeros(num_rows, dtype=np.uint8)
+    if num_rows == 0:
+        return flags
+    # Stable sort by metric, so that each metric keeps its own time order
+    # (and a timestamp going backwards is still visible).
+    metric_raw = batch_df['metric_id'].to_numpy(dtype='int64')
+    order = np.argsort(metric_raw, kind='stable')
+    metric = metric_raw[order]
+    value = batch_df['value'].to_numpy(dtype='float64')[order]
+    times = batch_df['measured_on'].to_numpy(dtype='datetime64[ns]')[order]
+    t_ns = times.astype('int64')
+    cat = pd.Series(metric).map(category_codes).fillna(
+        len(METRIC_CATEGORIES) - 1
+    ).to_numpy(dtype='int64')
+    rules = {col: rule_table[col].to_numpy()[cat] for col in rule_table}
+    sorted_flags = np.zeros(num_rows, dtype=np.uint8)
+
+    # previous reading of the same metric, falling back on the carry
+    new_metric = np.ones(num_rows, dtype=bool)
+    new_metric[1:] = metric[1:] != metric[:-1]
+    first_rows = np.flatnonzero(new_metric)
+    prev_value = np.empty(num_rows)
+    prev_value[1:] = value[:-1]
+    prev_t = np.empty(num_rows, dtype='int64')
+    prev_t[1:] = t_ns[:-1]
+    has_prev = ~new_metric
+    carried_run = np.zeros(num_rows, dtype='int64')
+    for row in first_rows:
+        last = carry.get(int(metric[row]))
+        if last is None:
+            prev_value[row] = np.nan
+            prev_t[row] = 0
+        else:
+            prev_value[row], carried_run[row], prev_t[row] = last
+            has_prev[row] = True
+
+    # range
+    with np.errstate(invalid='ignore'):
+        out_of_range = (value < rules['min']) | (value > rules['max'])
+    sorted_flags[out_of_range] |= QA_OUT_OF_RANGE
+    is_power = cat == METRIC_CATEGORIES.index('power')
+    sorted_flags[is_power & (value < NEGATIVE_POWER_TOLERANCE)]\
+        |= QA_NEGATIVE_POWER
+
+    # timestamp jumps: backwards, repeated, or a large forward gap
+    dt_ns = t_ns - prev_t
+    time_jump = has_prev & (
+        (dt_ns <= 0) | (dt_ns > MAX_GAP.value)
+    )
+    sorted_flags[time_jump] |= QA_TIME_JUMP
+
+    # rate of change, per minute
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate = np.abs(value - prev_value) / (dt_ns / 60e9)
+        too_fast = has_prev & (dt_ns > 0) & (rate > rules['max_rate'])
+    sorted_flags[too_fast] |= QA_RATE_OF_CHANGE
+
+    # stuck values: run lengths of identical readings per metric
+    same_as_prev = has_prev & (value == prev_value)
+    # every metric starts a new run, even if it matches its carried value
+    run_start = ~same_as_prev | new_metric
+    run_id = np.cumsum(run_start) - 1
+    run_length = np.bincount(run_id)
+    # a run continuing from the last batch picks up its carried length
+    run_length[run_id[first_rows]] += np.where(
+        same_as_prev[first_rows], carried_run[first_rows], 0
+    )
+    row_run_length = run_length[run_id]
+    stuck = (
+        (rules['stuck_run'] > 0)
+        & (row_run_length >= rules['stuck_run'])
+        & (value != 0)
+    )
+    sorted_flags[stuck] |= QA_STUCK
+
+    # nonzero readings while the sun is down
+    check_night = ~np.isnan(rules['night_max'])
+    if check_night.any():
+        utc = batch_df['utc_measured_on'].to_numpy(
+            dtype='datetime64[ns]'
+        )[order]
+        night = np.zeros(num_rows, dtype=bool)
+        night[check_night] = _night_mask(
+            utc[check_night], latitude, longitude
+        )
+        with np.errstate(invalid='ignore'):
+            sorted_flags[night & (value > rules['night_max'])]\
+                |= QA_NIGHT_NONZERO
+
+    # inverter clipping: a long, flat plateau at the daily maximum
+    check_clip = ~np.isnan(rules['clip_tolerance'])
+    if check_clip.any():
+        clip_metric = metric[check_clip]
+        clip_t = t_ns[check_clip]
+        clip_value = value[check_clip]
+        day = clip_t // 86_400_000_000_000
+        day_max = pd.Series(clip_value).groupby(
+            [clip_metric, day]
+        ).transform('max').to_numpy()
+        band = rules['clip_tolerance'][check_clip] * day_max
+        near_max = (day_max > 0) & (clip_value >= day_max - band)
+        # a flat step: this and the previous reading of the same metric
+        # and day are both at the maximum, with next to no change
+        flat_step = np.zeros(clip_value.shape[0], dtype=bool)
+        flat_step[1:] = (
+            (clip_metric[1:] == clip_metric[:-1])
+            & (day[1:] == day[:-1])
+            & near_max[1:] & near_max[:-1]
+            & (np.abs(clip_value[1:] - clip_value[:-1]) <= band[1:])
+        )
+        plateau_id = np.cumsum(~flat_step)
+        plateau_t = pd.Series(clip_t).groupby(plateau_id)
+        duration = (plateau_t.transform('max') - plateau_t.transform('min'))\
+            .to_numpy()
+        min_duration = rules['clip_min_minutes'][check_clip] * 60e9
+        clipped = np.zeros(num_rows, dtype=bool)
+        clipped[check_clip] = near_max & (duration >= min_duration)
+        sorted_flags[clipped] |= QA_CLIPPED
+
+    # update the carry with the last reading of each metric
+    last_rows = np.append(first_rows[1:] - 1, num_rows - 1)
+    for row in last_rows:
+        carry[int(metric[row])] = (
+            value[row], int(row_run_length[row]), int(t_ns[row])
+        )
+    flags[order] = sorted_flags
+    return flags
+
+
+def qa_system(system_id: int, selected_metrics, metrics_df: pd.DataFrame,
+              latitude: float, longitude: float,
+              source_dir='../../data/raw/systems/parquet/',
+              save_dir='../../data/qa/systems/parquet/',
+              rules=None, batch_size=1_000_000):
+    '''Stream one system through the QA rules, batch by batch.
+
+    Parameters
+    ------------
+    system_id: int
+        The system to check.
+    selected_metrics: iterable
+        The metric_ids to check.
+    metrics_df: pd.DataFrame
+        The parquet-metrics table, to find the metric categories.
+    latitude, longitude: float
+        Site location, for the night mask.
+    source_dir: str
+        Directory holding one sub-directory of raw parquet per system.
+    save_dir: str
+        Directory to write the flagged data to, in one sub-directory per
+        system like source_dir, or None to only compute the summary.
+    rules: dict
+        Overrides for DEFAULT_QA_RULES, by category.
+    batch_size: int
+        Maximum rows per record batch.
+
+    Returns
+    ------------
+    A dict summarising the flags for this system.
+    '''
+    all_rules = {
+        cat: {**DEFAULT_QA_RULES[cat], **((rules or {}).get(cat, {}))}
+        for cat in METRIC_CATEGORIES
+    }
+    rule_table = _rule_table(all_rules)
+    selected_metrics = [int(m) for m in selected_metrics]
+    categories = metric_categories(
+        metrics_df.loc[metrics_df.loc[:, 'system_id'] == system_id]
+    )
+    category_codes = {
+        m: METRIC_CATEGORIES.index(categories.get(m, 'other'))
+        for m in selected_metrics
+    }
+    dataset = ds.dataset(Path(f'{source_dir}{system_id}/'),
+                         format='parquet')
+    batches = dataset.to_batches(
+        columns=['measured_on', 'utc_measured_on', 'metric_id', 'value'],
+        filter=pc.field('metric_id').isin(selected_metrics),
+        batch_size=batch_size
+    )
+    writer = None
+    carry = {}
+    flag_counts = {name: 0 for name in QA_FLAG_NAMES.values()}
+    category_rows = {cat: 0 for cat in METRIC_CATEGORIES}
+    category_flagged = {cat: 0 for cat in METRIC_CATEGORIES}
+    num_rows = 0
+    num_flagged = 0
+    for batch in batches:
+        batch_df = batch.to_pandas()
+        flags = qa_batch(batch_df, category_codes, rule_table,
+                         latitude, longitude, carry)
+        num_rows += flags.shape[0]
+        num_flagged += int(np.count_nonzero(flags))
+        for bit, name in QA_FLAG_NAMES.items():
+            flag_counts[name] += int(np.count_nonzero(flags & bit))
+        batch_cats = batch_df['metric_id'].map(category_codes).fillna(
+            len(METRIC_CATEGORIES) - 1
+        ).to_numpy(dtype='int64')
+        rows_per_cat = np.bincount(batch_cats,
+                                   minlength=len(METRIC_CATEGORIES))
+        flagged_per_cat = np.bincount(batch_cats[flags != 0],
+                                      minlength=len(METRIC_CATEGORIES))
+        for j, cat in enumerate(METRIC_CATEGORIES):
+            category_rows[cat] += int(rows_per_cat[j])
+            category_flagged[cat] += int(flagged_per_cat[j])
+        if save_dir is not None:
+            out_batch = batch.append_column(
+                'qa_flags', pa.array(flags, type=pa.uint8())
+            )
+            if writer is None:
+                # same layout as the raw data, so readers of source_dir
+                # can be pointed at save_dir instead
+                save_path = Path(f'{save_dir}{system_id}/')
+                save_path.mkdir(parents=True, exist_ok=True)
+                writer = pq.ParquetWriter(
+                    save_path / f'system_{system_id}__qa.parquet',
+                    out_batch.schema
+                )
+            writer.write_batch(out_batch)
+    if writer is not None:
+        writer.close()
+    summary = {
+        'system_id': system_id,
+        'num_rows': num_rows,
+        'num_flagged': num_flagged,
+        'flagged_fraction': num_flagged / num_rows if num_rows else np.nan,
+    }
+    for name, count in flag_counts.items():
+        summary[f'num_{name}'] = count
+    for cat in METRIC_CATEGORIES:
+        summary[f'{cat}_rows'] = category_rows[cat]
+        summary[f'{cat}_flagged_fraction'] = (
+            category_flagged[cat] / category_rows[cat]
+            if category_rows[cat] else np.nan
+        )
+    return summary
+
+
+def judge_system(summary: dict, max_flagged_fraction=0.2,
+                 min_good_rows=10_000):
+    '''Decide from a QA summary if a system is worth running RdTools on.
+
+    Requires enough unflagged power and irradiance readings,
+    and not too many flagged readings of either.
+    '''
+    for cat in ['power', 'irradiance']:
+        rows = summary[f'{cat}_rows']
+        fraction = summary[f'{cat}_flagged_fraction']
+        if rows == 0 or fraction > max_flagged_fraction:
+            return False
+        if rows * (1 - fraction) < min_good_rows:
+            return False
+    return True
+
+
+def save_qa_summary(summaries, summary_path=QA_SUMMARY_PATH):
+    '''Add per-system QA summaries to the QA table,
+    replacing any older rows for the same systems.'''
+    new_df = pd.DataFrame(summaries)
+    summary_path = Path(summary_path)
+    if summary_path.is_file():
+        old_df = pd.read_csv(summary_path)
+        old_df = old_df.loc[
+            ~old_df.loc[:, 'system_id'].isin(new_df['system_id'])
+        ]
+        new_df = pd.concat([old_df, new_df], ignore_index=True)
+    new_df = new_df.sort_values('system_id')
+    new_df.to_csv(summary_path, index=False)
+    return new_df
+
+
+def qa_passing_systems(summary_path=QA_SUMMARY_PATH):
+    '''The system_ids that passed QA, for the degradation step.'''
+    summary_df = pd.read_csv(summary_path)
+    return list(
+        summary_df.loc[summary_df.loc[:, 'qa_pass'], 'system_id'].values
+    )
+
+
+if __name__ == '__main__':
+    metrics_dir = Path('../../data/raw/parquet-metrics/')
+    metrics_pq = pq.ParquetDataset(metrics_dir)
+    metrics_df = metrics_pq.read().to_pandas()
+    systems_cleaned = pd.read_csv('../../data/core/systems_cleaned.csv')
+    parquet_systems = systems_cleaned.loc[
+        systems_cleaned.loc[:, 'is_lake_parquet_data']
+    ]  # is already boolean!
+    irrad_parquet_systems = parquet_systems.loc[
+        parquet_systems.loc[:, 'has_irrad_data']
+    ]
+    summaries = []
+    for ind in irrad_parquet_systems.index:
+        system_id = int(irrad_parquet_systems.loc[ind, 'system_id'])
+        if not Path(f'../../data/raw/systems/parquet/{system_id}/')\
+                .is_dir():
+            continue  # not downloaded (yet)
+        system_metrics = metrics_df.loc[
+            metrics_df.loc[:, 'system_id'] == system_id, 'metric_id'
+        ]
+        summary = qa_system(
+            system_id,
+            system_metrics,
+            metrics_df,
+            irrad_parquet_systems.loc[ind, 'latitude'],
+            irrad_parquet_systems.loc[ind, 'longitude']
+        )
+        summary['qa_pass'] = judge_system(summary)
+        print(f'system_id={system_id}: '
+              + f'{summary["flagged_fraction"]:.4f} flagged, '
+              + f'pass={summary["qa_pass"]}')
+        summaries.append(summary)
+    if len(summaries) > 0:
+        save_qa_summary(summaries)
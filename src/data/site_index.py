@@ -0,0 +1,314 @@
+'''Spatial index over the system sites in systems_cleaned.
+
+Many of the ~1,860 systems sit on top of each other (Golden/Lakewood, CO,
+New Orleans, ...), so batch pipelines can share one weather fetch or
+clear-sky computation per cluster of sites, borrow irradiance from a
+nearby irradiance station (like 2045) for systems without sensors,
+and split train/test by spatial blocks, all without O(n^2) distance scans.
+
+Sites are placed on the unit sphere and stored in a KD-tree, so straight
+(chord) distances in the tree convert exactly to great-circle distances.'''
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+# prepare for future pandas 3.0 usage
+pd.options.mode.copy_on_write = True
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def _unit_vectors(latitude, longitude):
+    '''Latitude/longitude in degrees to points on the unit sphere.'''
+    lat = np.radians(np.asarray(latitude, dtype='float64'))
+    lon = np.radians(np.asarray(longitude, dtype='float64'))
+    return np.column_stack([
+        np.cos(lat) * np.cos(lon),
+        np.cos(lat) * np.sin(lon),
+        np.sin(lat),
+    ])
+
+
+def _km_to_chord(distance_km):
+    return 2 * np.sin(np.asarray(distance_km) / (2 * EARTH_RADIUS_KM))
+
+
+def _chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(
+        np.clip(np.asarray(chord) / 2, 0, 1)
+    )
+
+
+class SiteIndex:
+    '''KD-tree over site locations, keyed by system_id.
+
+    Parameters
+    ------------
+    sites_df: pd.DataFrame
+        Needs system_id, latitude and longitude columns; any other columns
+        (e.g. has_irrad_data, kg_climate) are kept in self.sites.
+        Rows without a location, and repeated system_ids, are dropped.
+    '''
+
+    def __init__(self, sites_df: pd.DataFrame):
+        sites = sites_df.dropna(subset=['latitude', 'longitude'])
+        sites = sites.drop_duplicates(subset='system_id')
+        self.sites = sites.reset_index(drop=True)
+        self.system_ids = self.sites['system_id'].to_numpy(dtype='int64')
+        self._position = pd.Series(
+            np.arange(self.system_ids.shape[0]), index=self.system_ids
+        )
+        self._points = _unit_vectors(self.sites['latitude'],
+                                     self.sites['longitude'])
+        self.tree = cKDTree(self._points)
+
+    def __len__(self):
+        return self.system_ids.shape[0]
+
+    def _query_points(self, system_ids=None, latitude=None, longitude=None):
+        '''Points for either some system_ids or some lat/lon pairs.'''
+        if system_ids is not None:
+            positions = self._position.loc[
+                np.atleast_1d(system_ids).astype('int64')
+            ].to_numpy()
+            return self._points[positions]
+        return _unit_vectors(np.atleast_1d(latitude),
+                             np.atleast_1d(longitude))
+
+    def nearest(self, system_ids=None, latitude=None, longitude=None, k=5,
+                exclude_self=True, candidates=None):
+        '''The k nearest systems to some systems or locations.
+
+        Parameters
+        ------------
+        system_ids: int or iterable, optional
+            Systems to search around.
+        latitude, longitude: float or iterable, optional
+            Locations to search around, if system_ids is not given.
+        k: int
+            Number of neighbors.
+        exclude_self: bool
+            Leave each system out of its own neighbors
+            (only used with system_ids).
+        candidates: iterable or None
+            If given, only these system_ids count as neighbors,
+            e.g. the systems with irradiance data.
+
+        Returns
+        ------------
+        A long-format pd.DataFrame of query, neighbor_id, distance_km and
+        rank, where query is the system_id (or the position of the
+        location in the input).
+        '''
+        points = self._query_points(system_ids, latitude, longitude)
+        if candidates is not None:
+            pool = SiteIndex(self.sites.loc[
+                self.sites.loc[:, 'system_id'].isin(list(candidates))
+            ])
+        else:
+            pool = self
+        drop_self = exclude_self and system_ids is not None
+        num_neighbors = min(k + int(drop_self), len(pool))
+        if num_neighbors == 0:
+            raise ValueError('No candidate systems to search!')
+        chords, positions = pool.tree.query(points, k=num_neighbors)
+        chords = chords.reshape(points.shape[0], num_neighbors)
+        positions = positions.reshape(points.shape[0], num_neighbors)
+        if system_ids is not None:
+            queries = np.atleast_1d(system_ids).astype('int64')
+        else:
+            queries = np.arange(points.shape[0])
+        result = pd.DataFrame({
+            'query': np.repeat(queries, num_neighbors),
+            'neighbor_id': pool.system_ids[positions.ravel()],
+            'distance_km': _chord_to_km(chords.ravel()),
+        })
+        if drop_self:
+            result = result.loc[result['query'] != result['neighbor_id']]
+        result['rank'] = result.groupby('query').cumcount() + 1
+        result = result.loc[result['rank'] <= k]
+        return result.reset_index(drop=True)
+
+    def within(self, radius_km: float, system_ids=None, latitude=None,
+               longitude=None, exclude_self=True):
+        '''All systems within radius_km of some systems or locations.
+
+        Returns the same long format as nearest, ordered by distance.
+        '''
+        points = self._query_points(system_ids, latitude, longitude)
+        hits = self.tree.query_ball_point(points, _km_to_chord(radius_km))
+        if system_ids is not None:
+            queries = np.atleast_1d(system_ids).astype('int64')
+        else:
+            queries = np.arange(points.shape[0])
+        counts = np.array([len(h) for h in hits], dtype='int64')
+        positions = np.concatenate(
+            [np.asarray(h, dtype='int64') for h in hits]
+        ) if counts.sum() > 0 else np.array([], dtype='int64')
+        query_points = np.repeat(points, counts, axis=0)
+        chords = np.linalg.norm(self._points[positions] - query_points,
+                                axis=1)
+        result = pd.DataFrame({
+            'query': np.repeat(queries, counts),
+            'neighbor_id': self.system_ids[positions],
+            'distance_km': _chord_to_km(chords),
+        })
+        if exclude_self and system_ids is not None:
+            result = result.loc[result['query'] != result['neighbor_id']]
+        result = result.sort_values(['query', 'distance_km'],
+                                    kind='stable')
+        result['rank'] = result.groupby('query').cumcount() + 1
+        return result.reset_index(drop=True)
+
+    def co_located_groups(self, radius_km=1.):
+        '''Label clusters of sites, chaining any two within radius_km.
+
+        Sites in one group can share a weather fetch or clear-sky run.
+
+        Returns
+        ------------
+        A pd.Series of group labels (0, 1, ...) indexed by system_id.
+        '''
+        pairs = self.tree.query_pairs(_km_to_chord(radius_km),
+                                      output_type='ndarray')
+        num_sites = len(self)
+        adjacency = coo_matrix(
+            (np.ones(pairs.shape[0]), (pairs[:, 0], pairs[:, 1])),
+            shape=(num_sites, num_sites)
+        )
+        _, labels = connected_components(adjacency, directed=False)
+        return pd.Series(labels, index=self.system_ids, name='group')
+
+    def group_representatives(self, radius_km=1.):
+        '''One representative system (closest to its group's centroid) per
+        co-located group, and the group of every system.
+
+        Returns
+        ------------
+        A pd.DataFrame indexed by system_id with group and
+        representative_id columns; fetch once per representative_id.
+        '''
+        groups = self.co_located_groups(radius_km)
+        centroids = pd.DataFrame(self._points, index=self.system_ids)\
+            .groupby(groups.to_numpy()).transform('mean').to_numpy()
+        offset = np.linalg.norm(self._points - centroids, axis=1)
+        frame = pd.DataFrame({
+            'system_id': self.system_ids,
+            'group': groups.to_numpy(),
+            'offset': offset,
+        })
+        representative = frame.loc[
+            frame.groupby('group')['offset'].idxmin(), ['group', 'system_id']
+        ].set_index('group')['system_id']
+        frame['representative_id'] = frame['group'].map(representative)
+        return frame.set_index('system_id')[['group', 'representative_id']]
+
+    def irradiance_donors(self, system_ids=None, max_km=25.,
+                          flag='has_irrad_data'):
+        '''Nearest system with irradiance data for systems without it.
+
+        Parameters
+        ------------
+        system_ids: iterable or None
+            Systems needing irradiance; default every system whose
+            flag column is False.
+        max_km: float
+            Farthest acceptable donor.
+        flag: str
+            Boolean column of self.sites marking irradiance data.
+
+        Returns
+        ------------
+        A pd.DataFrame of system_id, donor_id and distance_km;
+        systems with no donor inside max_km are left out.
+        '''
+        has_irrad = self.sites[flag].astype('boolean').fillna(False)\
+            .to_numpy(dtype=bool)
+        if system_ids is None:
+            system_ids = self.system_ids[~has_irrad]
+        donors = self.nearest(system_ids, k=1,
+                              candidates=self.system_ids[has_irrad])
+        donors = donors.loc[donors['distance_km'] <= max_km]
+        return donors.rename(columns={
+            'query': 'system_id', 'neighbor_id': 'donor_id'
+        })[['system_id', 'donor_id', 'distance_km']].reset_index(drop=True)
+
+    def spatial_train_test_split(self, test_size=0.2, block_km=25.,
+                                 seed=None):
+        '''Split system_ids into train and test by spatial blocks.
+
+        Sites are chained into blocks (co_located_groups with
+        radius block_km), and whole blocks are assigned at random, so
+        that no test system has a train system within block_km.
+
+        The shuffled blocks go to the test set one at a time, skipping any
+        block that would overshoot the target; the smallest skipped block
+        is then added if that lands closer.  The test set is therefore off
+        the target by at most half the smallest skipped block.  Most blocks
+        are single sites, so on systems_cleaned with the defaults the test
+        fraction is within one site (0.05%) of test_size.
+
+        Returns
+        ------------
+        (train_ids, test_ids), as np.ndarrays of system_id.
+        '''
+        rng = np.random.default_rng(seed)
+        groups = self.co_located_groups(block_km)
+        sizes = groups.value_counts()
+        order = rng.permutation(sizes.index.to_numpy())
+        target = test_size * len(self)
+        test_groups = set()
+        num_test = 0
+        skipped = []
+        for group in order:
+            size = int(sizes.loc[group])
+            if num_test + size <= target:
+                test_groups.add(group)
+                num_test += size
+            else:
+                skipped.append(group)
+        # one more block, if it lands closer to the target
+        if len(skipped) > 0:
+            smallest = min(skipped, key=lambda g: sizes.loc[g])
+            if abs(num_test + sizes.loc[smallest] - target)\
+                    < abs(num_test - target):
+                test_groups.add(smallest)
+        is_test = groups.isin(test_groups).to_numpy()
+        return self.system_ids[~is_test], self.system_ids[is_test]
+
+
+def load_site_index(systems_path='../../data/core/systems_cleaned.csv',
+                    extra_sites=None):
+    '''Build a SiteIndex from systems_cleaned.
+
+    Parameters
+    ------------
+    systems_path: str
+        Path to systems_cleaned.csv.
+    extra_sites: pd.DataFrame or None
+        More sites with system_id/latitude/longitude (and flags), e.g.
+        irradiance station 2045 from the parquet-sites table, which
+        systems_initializer.py leaves out of systems_cleaned.
+    '''
+    sites_df = pd.read_csv(Path(systems_path))
+    if extra_sites is not None:
+        sites_df = pd.concat([sites_df, extra_sites], ignore_index=True)
+    return SiteIndex(sites_df)
+
+
+if __name__ == '__main__':
+    site_index = load_site_index()
+    print(f'{len(site_index)} sites indexed.')
+    representatives = site_index.group_representatives(radius_km=1.)
+    print(f'{representatives["representative_id"].nunique()} weather '
+          + 'fetches needed at 1 km, instead of '
+          + f'{len(site_index)}.')
+    donors = site_index.irradiance_donors(max_km=25.)
+    print(f'{donors.shape[0]} systems without irradiance data have '
+          + 'an irradiance donor within 25 km.')
+    train_ids, test_ids = site_index.spatial_train_test_split(seed=0)
+    print(f'{train_ids.shape[0]} train and {test_ids.shape[0]} test sites.')
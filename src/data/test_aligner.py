@@ -0,0 +1,41 @@
+'''Tests for aligner.py, fed from the output of the QA stage.'''
+
+import numpy as np
+import pandas as pd
+from aligner import align_system
+from sensor_qa import qa_system
+from test_sensor_qa import _batch, write_raw_system
+
+METRICS_DF = pd.DataFrame({'system_id': [99], 'metric_id': [3],
+                           'sensor_name': ['ac_power'],
+                           'common_name': ['AC Power']})
+
+
+def test_align_system_drops_rows_flagged_in_qa_output(tmp_path):
+    minutes = np.arange(24 * 60)
+    power = np.clip(
+        4000 * np.sin(np.pi * (minutes - 6 * 60) / (12 * 60)), 0, None
+    )
+    # half an hour of bad negative readings at noon
+    noon = (minutes >= 12 * 60) & (minutes < 12 * 60 + 30)
+    power[noon] = -500.
+    write_raw_system(tmp_path / 'raw', 99,
+                     _batch({3: power}, '2020-06-01 00:00'))
+    summary = qa_system(99, [3], METRICS_DF, 39.7, -105.2,
+                        source_dir=f'{tmp_path}/raw/',
+                        save_dir=f'{tmp_path}/qa/')
+    assert summary['num_negative_power'] == noon.sum()
+    from_raw = align_system(99, [3], METRICS_DF, grid='15min',
+                            source_dir=f'{tmp_path}/raw/')
+    from_qa = align_system(99, [3], METRICS_DF, grid='15min',
+                           source_dir=f'{tmp_path}/qa/')
+    kept_flagged = align_system(99, [3], METRICS_DF, grid='15min',
+                                source_dir=f'{tmp_path}/qa/',
+                                drop_flagged=False)
+    assert (from_raw['value'] < 0).any()
+    assert not (from_qa['value'] < 0).any()
+    noon_bins = from_qa['measured_on'].isin(
+        pd.date_range('2020-06-01 12:00', periods=2, freq='15min')
+    )
+    assert (from_qa.loc[noon_bins, 'n_samples'] == 0).all()
+    pd.testing.assert_frame_equal(kept_flagged, from_raw)
@@ -0,0 +1,108 @@
+'''Regression tests for the QA rules in sensor_qa.py.'''
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sensor_qa import (
+    DEFAULT_QA_RULES, METRIC_CATEGORIES, QA_CLIPPED, QA_STUCK,
+    _rule_table, qa_batch, qa_system
+)
+
+CATEGORY_CODES = {
+    1: METRIC_CATEGORIES.index('other'),
+    2: METRIC_CATEGORIES.index('other'),
+    3: METRIC_CATEGORIES.index('power'),
+}
+
+
+def _batch(metric_values: dict, start: str):
+    '''Long-format 1 minute data, metrics interleaved as in pvdata.'''
+    frames = []
+    for metric_id, values in metric_values.items():
+        times = pd.date_range(start, periods=len(values), freq='1min')
+        frames.append(pd.DataFrame({
+            'measured_on': times,
+            'utc_measured_on': times + pd.Timedelta(hours=7),
+            'metric_id': metric_id,
+            'value': np.asarray(values, dtype='float64'),
+        }))
+    return pd.concat(frames).sort_values('measured_on', kind='stable')\
+        .reset_index(drop=True)
+
+
+def _rules(**overrides):
+    rules = {cat: dict(DEFAULT_QA_RULES[cat]) for cat in METRIC_CATEGORIES}
+    rules['other'].update(overrides)
+    return _rule_table(rules)
+
+
+def test_stuck_runs_continue_across_batches_per_metric():
+    rule_table = _rules(stuck_run=15)
+    carry = {}
+    first = _batch({1: [5.] * 10, 2: [7.] * 10}, '2020-06-01 00:00')
+    qa_batch(first, CATEGORY_CODES, rule_table, 39.7, -105.2, carry)
+    assert carry[1][:2] == (5., 10)
+    assert carry[2][:2] == (7., 10)
+    # metric 1 moves on, metric 2 starts exactly where it stopped
+    second = _batch({1: np.arange(1., 11.), 2: [7.] * 10},
+                    '2020-06-01 00:10')
+    flags = qa_batch(second, CATEGORY_CODES, rule_table, 39.7, -105.2,
+                     carry)
+    assert carry[1][:2] == (10., 1)
+    assert carry[2][:2] == (7., 20)
+    stuck = (flags & QA_STUCK) != 0
+    assert not stuck[second['metric_id'].to_numpy() == 1].any()
+    assert stuck[second['metric_id'].to_numpy() == 2].all()
+
+
+def test_batch_starting_on_its_carried_value():
+    rule_table = _rules(stuck_run=30)
+    carry = {1: (0., 4, pd.Timestamp('2020-05-31 23:59').value)}
+    batch = _batch({1: [0., 0., 3., 3.]}, '2020-06-01 00:00')
+    flags = qa_batch(batch, CATEGORY_CODES, rule_table, 39.7, -105.2, carry)
+    assert not (flags & QA_STUCK).any()
+    assert carry[1][:2] == (3., 2)
+
+
+def test_smooth_peak_is_not_clipping():
+    minutes = np.arange(6 * 60, 18 * 60)
+    power = 5000 * np.sin(np.pi * (minutes - 6 * 60) / (12 * 60))
+    batch = _batch({3: power}, '2020-06-01 06:00')
+    flags = qa_batch(batch, CATEGORY_CODES, _rules(), 39.7, -105.2, {})
+    assert not (flags & QA_CLIPPED).any()
+    # the same day, clipped at 4 kW, is flagged on the plateau only
+    clipped_power = np.minimum(power, 4000.)
+    batch = _batch({3: clipped_power}, '2020-06-01 06:00')
+    flags = qa_batch(batch, CATEGORY_CODES, _rules(), 39.7, -105.2, {})
+    clipped = (flags & QA_CLIPPED) != 0
+    assert np.array_equal(clipped, clipped_power == 4000.)
+
+
+def write_raw_system(raw_dir, system_id, batch_df):
+    '''Write batch_df as one day file per date, like the raw pvdata.'''
+    system_dir = raw_dir / f'{system_id}'
+    system_dir.mkdir(parents=True)
+    days = batch_df['measured_on'].dt.date
+    for day, day_df in batch_df.groupby(days):
+        pq.write_table(
+            pa.Table.from_pandas(day_df, preserve_index=False),
+            system_dir / f'system_{system_id}__date_{day:%Y_%m_%d}.parquet'
+        )
+
+
+def test_qa_output_has_the_raw_layout(tmp_path):
+    power = np.r_[np.zeros(60), np.full(60, 250.), np.zeros(60)]
+    write_raw_system(tmp_path / 'raw', 99,
+                     _batch({3: power}, '2020-06-01 23:00'))
+    metrics_df = pd.DataFrame({'system_id': [99], 'metric_id': [3],
+                               'sensor_name': ['ac_power'],
+                               'common_name': ['AC Power']})
+    summary = qa_system(99, [3], metrics_df, 39.7, -105.2,
+                        source_dir=f'{tmp_path}/raw/',
+                        save_dir=f'{tmp_path}/qa/')
+    qa_table = ds.dataset(tmp_path / 'qa' / '99', format='parquet')\
+        .to_table()
+    assert qa_table.num_rows == summary['num_rows'] == power.shape[0]
+    assert 'qa_flags' in qa_table.schema.names
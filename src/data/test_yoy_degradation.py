@@ -0,0 +1,39 @@
+'''Check yoy_degradation.py against RdTools on awkward inputs.'''
+
+import numpy as np
+import pandas as pd
+import pytest
+from yoy_degradation import check_against_rdtools
+
+
+def _degrading(index, seed, gap_fraction=0.):
+    '''Noisy normalized energy losing 0.5 %/year, with random gaps.'''
+    rng = np.random.default_rng(seed)
+    years = np.asarray((index - index[0]) / pd.Timedelta('365D'))
+    energy = pd.Series(1 - 0.005 * years
+                       + rng.normal(0, 0.02, index.shape[0]), index=index)
+    gaps = rng.random(index.shape[0]) < gap_fraction
+    energy[gaps] = np.nan
+    return energy
+
+
+@pytest.mark.parametrize('energy_normalized', [
+    # Feb 28 and 29 shift onto the same day, making ties
+    pytest.param(_degrading(
+        pd.date_range('2015-06-01', '2021-05-31', freq='D'), 0
+    ), id='leap_years'),
+    # missing values and missing days, so points pair up unevenly
+    pytest.param(_degrading(
+        pd.date_range('2012-01-01', '2017-12-31', freq='D'), 1, 0.2
+    ).sample(frac=0.9, random_state=1), id='gappy'),
+    pytest.param(_degrading(
+        pd.date_range('2016-01-03', periods=160, freq='W'), 2
+    ), id='weekly'),
+    pytest.param(_degrading(
+        pd.date_range('2015-01-01', '2019-12-31', freq='D',
+                      tz='America/Denver'), 3, 0.05
+    ), id='tz_aware'),
+])
+def test_identical_to_rdtools(energy_normalized):
+    assert check_against_rdtools(energy_normalized, seed=7)
+    assert check_against_rdtools(energy_normalized, seed=7, recenter=False)